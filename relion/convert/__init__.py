@@ -71,6 +71,8 @@ def writeSetOfParticles(imgSet, starFile, **kwargs):
         alignType:
         extraLabels:
         postprocessImageRow:
+        forceConvert: If True, always convert the binary files
+        nThreads: number of threads to convert binary files (default 1)
     """
     return createWriter(**kwargs).writeSetOfParticles(imgSet, starFile, **kwargs)
 
@@ -30,21 +30,39 @@ New conversion functions dealing with Relion3.1 new star files format.
 """
 import os
 import io
+import math
+import itertools
+import operator
 import numpy as np
-from collections import OrderedDict
 from emtable import Table
 
 
 from pwem.constants import ALIGN_NONE, ALIGN_PROJ, ALIGN_2D, ALIGN_3D
 from pwem.objects import (Micrograph, SetOfMicrographsBase, SetOfMovies,
                           Particle, CTFModel, Acquisition, Transform, Coordinate)
-import pwem.convert.transformations as tfs
 
 from .convert_base import WriterBase, ReaderBase
 from .convert_utils import (convertBinaryFiles, locationToRelion,
-                            relionToLocation)
+                            relionToLocation, iterStarRows)
 from relion.constants import PARTICLE_EXTRA_LABELS
 
+# Use a large write buffer for star files, since the rows are written
+# one by one and big particle sets would otherwise produce too many
+# small writes to disk.
+STAR_BUFFER_SIZE = 1 << 20
+
+# Number of particles rows that are processed together when reading
+# a star file, e.g. to compute all transformation matrices at once.
+READ_CHUNK_SIZE = 10000
+
+# Number of particles that are buffered when writing a star file, e.g. to
+# compute the alignment values for all of them at once.
+WRITE_CHUNK_SIZE = 10000
+
+_DEG2RAD = math.pi / 180.
+_RAD2DEG = 180. / math.pi
+_EPS = np.finfo(float).eps * 4.0
+
 
 def getPixelSizeLabel(imageSet):
     """ Return the proper label for pixel size. """
@@ -55,6 +73,104 @@ def getPixelSizeLabel(imageSet):
         return 'rlnImagePixelSize'
 
 
+def setEulerMatrix(M, rot, tilt, psi, sin=math.sin, cos=math.cos):
+    """ Fill the rotation part of M with the same values that
+    tfs.euler_matrix(-rot, -tilt, -psi, 'szyz') would produce.
+
+    Params:
+        M: a (4, 4) matrix, or a (N, 4, 4) array of matrices.
+        rot, tilt, psi: angles in radians, either scalars or arrays of
+            length N (in which case numpy sin and cos should be passed).
+    """
+    si, sj, sk = sin(rot), sin(tilt), sin(psi)
+    ci, cj, ck = cos(rot), cos(tilt), cos(psi)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    M[..., 0, 0] = cj * cc - ss
+    M[..., 0, 1] = cj * sc + cs
+    M[..., 0, 2] = -sj * ck
+    M[..., 1, 0] = -cj * cs - sc
+    M[..., 1, 1] = -cj * ss + cc
+    M[..., 1, 2] = sj * sk
+    M[..., 2, 0] = sj * ci
+    M[..., 2, 1] = sj * si
+    M[..., 2, 2] = cj
+
+
+def eulerMatrices(rot, tilt, psi, out=None):
+    """ Vectorized version of tfs.euler_matrix(-rot, -tilt, -psi, 'szyz').
+
+    Params:
+        rot, tilt, psi: arrays (of the same length N) with angles in radians.
+        out: optional array with at least N matrices, that will be filled
+            instead of allocating a new one.
+    Return:
+        A (N, 4, 4) array with one homogeneous rotation matrix per angles set.
+    """
+    if out is None:
+        M = np.zeros((len(rot), 4, 4))
+    else:
+        M = out[:len(rot)]
+        M[:, :, 3] = 0.
+        M[:, 3, :3] = 0.
+    M[:, 3, 3] = 1.
+    setEulerMatrix(M, rot, tilt, psi, np.sin, np.cos)
+
+    return M
+
+
+def inverseTransform(M):
+    """ Inverse of a rigid transformation matrix [[R, t], [0, 1]], or of a
+    (N, 4, 4) stack of them. R should be a rotation, maybe uniformly scaled,
+    so the inverse is computed from its transpose instead of np.linalg.inv.
+    """
+    R = M[..., :3, :3]
+    Rt = np.swapaxes(R, -1, -2) / (R[..., :1, :] ** 2).sum(axis=-1)[..., None]
+    Minv = np.zeros_like(M)
+    Minv[..., :3, :3] = Rt
+    Minv[..., :3, 3] = -np.matmul(Rt, M[..., :3, 3:])[..., 0]
+    Minv[..., 3, 3] = 1.
+
+    return Minv
+
+
+def eulerAnglesFromMatrices(M):
+    """ Vectorized version of tfs.euler_from_matrix(M, 'szyz') with the
+    sign of the angles changed, so it is the inverse of eulerMatrices.
+
+    Params:
+        M: a (N, 4, 4) or (N, 3, 3) array of matrices.
+    Return:
+        A (N, 3) array with the (rot, tilt, psi) angles in radians.
+    """
+    sy = np.hypot(M[:, 2, 1], M[:, 2, 0])
+    regular = sy > _EPS
+    rot = np.where(regular,
+                   np.arctan2(M[:, 2, 1], M[:, 2, 0]),
+                   np.arctan2(-M[:, 1, 0], M[:, 1, 1]))
+    tilt = np.arctan2(sy, M[:, 2, 2])
+    psi = np.where(regular, np.arctan2(M[:, 1, 2], -M[:, 0, 2]), 0.)
+
+    return np.column_stack([rot, tilt, psi])
+
+
+def eulerAnglesFromMatrix(M):
+    """ Scalar version of eulerAnglesFromMatrices for a single matrix,
+    that can also be given as nested lists (e.g. from M.tolist()).
+    It is faster than the vectorized one when converting row by row.
+
+    Return:
+        The (rot, tilt, psi) angles in radians.
+    """
+    sy = math.hypot(M[2][1], M[2][0])
+    tilt = math.atan2(sy, M[2][2])
+    if sy > _EPS:
+        return (math.atan2(M[2][1], M[2][0]), tilt,
+                math.atan2(M[1][2], -M[0][2]))
+    return math.atan2(-M[1][0], M[1][1]), tilt, 0.
+
+
 class OpticsGroups:
     """ Store information about optics groups in an indexable way.
     Existing groups can be accessed by number of name.
@@ -64,9 +180,9 @@ class OpticsGroups:
         self.__fromTable(opticsTable)
 
     def __fromTable(self, opticsTable):
-        self._dict = OrderedDict()
+        self._dict = {}
         # Also allow indexing by name
-        self._dictName = OrderedDict()
+        self._dictName = {}
         # Map optics rows both by name and by number
         for og in opticsTable:
             self.__store(og)
@@ -258,7 +374,7 @@ class Writer(WriterBase):
         self._postprocessImageRow = kwargs.get('postprocessImageRow', None)
         self._prefix = tableName[:3]
 
-        micRow = OrderedDict()
+        micRow = {}
         micRow[imgLabelName] = ''  # Just to add label, proper value later
         iterMics = iter(imgIterable)
         mic = next(iterMics)
@@ -268,8 +384,7 @@ class Writer(WriterBase):
         self._setCtf = mic.hasCTF()
 
         extraLabels = kwargs.get('extraLabels', [])
-        self._extraLabels = [l for l in extraLabels
-                             if mic.hasAttribute('_%s' % l)]
+        self._extraLabels = self._getObjLabels(mic, extraLabels)
 
         self._micToRow(mic, micRow)
         if self._postprocessImageRow:
@@ -284,23 +399,34 @@ class Writer(WriterBase):
             if self._postprocessImageRow:
                 self._postprocessImageRow(mic, micRow)
 
-            micsTable.addRow(**micRow)
+            # Values are already in the same order of the table columns
+            micsTable.addRow(*micRow.values())
             mic = next(iterMics, None)
 
-        with open(starFile, 'w') as f:
+        with open(starFile, 'w', buffering=STAR_BUFFER_SIZE) as f:
             f.write("# Star file generated with Scipion\n")
             f.write("# version 30001\n")
             self._optics.toStar(f)
             f.write("# version 30001\n")
             micsTable.writeStar(f, tableName=tableName)
 
+    def _getObjLabels(self, obj, labels):
+        """ Return (label, attrName) pairs for the labels that are present
+        as attributes (with _ prefix) in the given object. The result is
+        intended to be computed once and then used with _objToRow.
+        """
+        return [(l, '_' + l) for l in labels if obj.hasAttribute('_' + l)]
+
     def _objToRow(self, obj, row, attributes):
         """ Set some attributes from the object to the row.
         For performance reasons, it is not validated that each attribute
         is already in the object, so it should be validated before.
+
+        Params:
+            attributes: list of (label, attrName) pairs, see _getObjLabels
         """
-        for attr in attributes:
-            row[attr] = obj.getAttributeValue('_%s' % attr)
+        for label, attrName in attributes:
+            row[label] = obj.getAttributeValue(attrName)
 
     def _micToRow(self, mic, row):
         WriterBase._micToRow(self, mic, row)
@@ -313,21 +439,97 @@ class Writer(WriterBase):
         self._objToRow(mic, row, self._extraLabels)
         row['rlnOpticsGroup'] = mic.getAttributeValue('_rlnOpticsGroup', 1)
 
+    def _alignmentValues(self, M):
+        """ Compute the alignment values of the rows (in the order of
+        self._alignLabels) for a (N, 4, 4) stack of transformation matrices.
+        """
+        ps = self._pixelSize
+        if self._alignProj:
+            M = inverseTransform(M)
+            shifts = -M[:, :3, 3] * ps
+            angles = np.rad2deg(eulerAnglesFromMatrices(M))
+            return np.column_stack([shifts, angles])
+        else:
+            shifts = M[:, :2, 3] * ps
+            angles = np.rad2deg(eulerAnglesFromMatrices(M))
+            return np.column_stack([shifts, -(angles[:, 0] + angles[:, 2])])
+
     def _align2DToRow(self, alignment, row):
-        matrix = alignment.getMatrix()
-        shifts = tfs.translation_from_matrix(matrix)
-        shifts *= self._pixelSize
-        angles = -np.rad2deg(tfs.euler_from_matrix(matrix, axes='szyz'))
-        row['rlnOriginXAngst'], row['rlnOriginYAngst'] = shifts[:2]
-        row['rlnAnglePsi'] = -(angles[0] + angles[2])
+        m = alignment.getMatrix().tolist()
+        rot, _, psi = eulerAnglesFromMatrix(m)
+        ps = self._pixelSize
+        row['rlnOriginXAngst'] = m[0][3] * ps
+        row['rlnOriginYAngst'] = m[1][3] * ps
+        row['rlnAnglePsi'] = -(rot + psi) * _RAD2DEG
 
     def _alignProjToRow(self, alignment, row):
-        matrix = np.linalg.inv(alignment.getMatrix())
-        shifts = -tfs.translation_from_matrix(matrix)
-        shifts *= self._pixelSize
-        angles = -np.rad2deg(tfs.euler_from_matrix(matrix, axes='szyz'))
-        row['rlnOriginXAngst'], row['rlnOriginYAngst'], row['rlnOriginZAngst'] = shifts
-        row['rlnAngleRot'], row['rlnAngleTilt'], row['rlnAnglePsi'] = angles
+        # Inverse of the rigid transformation [R, t] is [R', -R't], where
+        # R' is the transpose of R (divided by the squared scale, if any)
+        (r00, r01, r02, tx), (r10, r11, r12, ty), (r20, r21, r22, tz), _ = \
+            alignment.getMatrix().tolist()
+        s2 = r00 * r00 + r01 * r01 + r02 * r02
+        Rt = [[r00 / s2, r10 / s2, r20 / s2],
+              [r01 / s2, r11 / s2, r21 / s2],
+              [r02 / s2, r12 / s2, r22 / s2]]
+        rot, tilt, psi = eulerAnglesFromMatrix(Rt)
+        ps = self._pixelSize
+        row['rlnOriginXAngst'] = (Rt[0][0] * tx + Rt[0][1] * ty
+                                   + Rt[0][2] * tz) * ps
+        row['rlnOriginYAngst'] = (Rt[1][0] * tx + Rt[1][1] * ty
+                                   + Rt[1][2] * tz) * ps
+        row['rlnOriginZAngst'] = (Rt[2][0] * tx + Rt[2][1] * ty
+                                   + Rt[2][2] * tz) * ps
+        row['rlnAngleRot'] = rot * _RAD2DEG
+        row['rlnAngleTilt'] = tilt * _RAD2DEG
+        row['rlnAnglePsi'] = psi * _RAD2DEG
+
+    def _alignToBuffer(self, alignment, row):
+        """ Store the alignment matrix, the values of the row will be
+        computed later for a chunk of particles at once (see _writeRows).
+        """
+        self._alignMatrices[self._alignCount] = alignment.getMatrix()
+        self._alignCount += 1
+
+    def _computeLineFormat(self, values):
+        """ Compute a %-format string for the rows, with the same columns
+        width and float precision that Table.Writer uses.
+        """
+        formats = []
+        for v in values:
+            if isinstance(v, float):
+                f = '%d.6f' % (len('%0.6f' % v) + 1)
+            elif isinstance(v, bool):  # written as int, like str.format does
+                f = '%dd' % (len(str(v)) + 1)
+            else:
+                f = '%ds' % (len(str(v)) + 1)
+            formats.append('%' + f + ' ')
+        return ' '.join(formats) + '\n'
+
+    def _writeRows(self, f, rowsValues):
+        """ Write a chunk of rows, setting first the alignment values
+        (if any) of all of them in a single vectorized pass.
+        """
+        if self._alignCount:
+            M = self._alignMatrices[:self._alignCount]
+            alignValues = self._alignmentValues(M)
+
+            columns = self._alignColumns
+            for values, aValues in zip(rowsValues, alignValues.tolist()):
+                for i, v in zip(columns, aValues):
+                    values[i] = v
+            self._alignCount = 0
+
+        # None would be written as 'None', Table.Writer fails instead
+        for values in rowsValues:
+            if None in values:
+                raise TypeError("Invalid None value for column '%s'"
+                                % self._columnNames[values.index(None)])
+
+        if rowsValues:
+            if self._lineFormat is None:
+                self._lineFormat = self._computeLineFormat(rowsValues[0])
+            lineFormat = self._lineFormat
+            f.write(''.join([lineFormat % tuple(v) for v in rowsValues]))
 
     def _partToRow(self, part, row):
         row['rlnImageId'] = part.getObjId()
@@ -381,8 +583,7 @@ class Writer(WriterBase):
         self.update(['rootDir', 'outputDir', 'outputStack'], **kwargs)
 
         self._optics = OpticsGroups.fromImages(partsSet)
-        partRow = OrderedDict()
-        firstPart = partsSet.getFirstItem()
+        partRow = {}
 
         # Convert binaries if required
         if self.outputStack:
@@ -390,8 +591,15 @@ class Writer(WriterBase):
                                                    os.path.dirname(starFile))
         if self.outputDir is not None:
             forceConvert = kwargs.get('forceConvert', False)
-            self._filesDict = convertBinaryFiles(partsSet, self.outputDir,
-                                                 forceConvert=forceConvert)
+            self._filesDict = convertBinaryFiles(
+                partsSet, self.outputDir, forceConvert=forceConvert,
+                nThreads=kwargs.get('nThreads', 1))
+
+        # The set is iterated only once, the first particle is used to
+        # compute the flags and then it is also written in the loop below.
+        # No other queries should be done on the set during the iteration
+        iterParts = iter(partsSet)
+        firstPart = next(iterParts)
 
         # Compute some flags from the first particle...
         # when flags are True, some operations will be applied to all particles
@@ -401,10 +609,16 @@ class Writer(WriterBase):
 
         alignType = kwargs.get('alignType', partsSet.getAlignment())
 
+        self._alignProj = alignType == ALIGN_PROJ
         if alignType == ALIGN_2D:
             self._setAlign = self._align2DToRow
+            self._alignLabels = ['rlnOriginXAngst', 'rlnOriginYAngst',
+                                 'rlnAnglePsi']
         elif alignType == ALIGN_PROJ:
             self._setAlign = self._alignProjToRow
+            self._alignLabels = ['rlnOriginXAngst', 'rlnOriginYAngst',
+                                 'rlnOriginZAngst', 'rlnAngleRot',
+                                 'rlnAngleTilt', 'rlnAnglePsi']
         elif alignType == ALIGN_3D:
             raise NotImplementedError(
                 "3D alignment conversion for Relion not implemented. "
@@ -417,18 +631,16 @@ class Writer(WriterBase):
         else:
             raise TypeError("Invalid value for alignType: %s" % alignType)
 
-        extraLabels = kwargs.get('extraLabels', [])
-        extraLabels.extend(PARTICLE_EXTRA_LABELS)
-        self._extraLabels = [l for l in extraLabels
-                             if firstPart.hasAttribute('_%s' % l)]
+        # Do not extend the input list, it might be reused by the caller
+        extraLabels = kwargs.get('extraLabels', []) + PARTICLE_EXTRA_LABELS
+        self._extraLabels = self._getObjLabels(firstPart, extraLabels)
 
         coord = firstPart.getCoordinate()
         self._coordLabels = []
         if coord is not None:
-            self._coordLabels = [l for l in ['rlnClassNumber',
-                                             'rlnAutopickFigureOfMerit',
-                                             'rlnAnglePsi']
-                                 if coord.hasAttribute('_%s' % l)]
+            self._coordLabels = self._getObjLabels(
+                coord, ['rlnClassNumber', 'rlnAutopickFigureOfMerit',
+                        'rlnAnglePsi'])
 
         self._postprocessImageRow = kwargs.get('postprocessImageRow', None)
 
@@ -436,16 +648,27 @@ class Writer(WriterBase):
         self._pixelSize = firstPart.getSamplingRate() or 1.0
 
         self._counter = 0  # Mark first conversion as special one
-        firstPart.setAcquisition(partsSet.getAcquisition())
         self._partToRow(firstPart, partRow)
 
         if self._postprocessImageRow:
             self._postprocessImageRow(firstPart, partRow)
 
-        partsTable = self._createTableFromDict(partRow)
-        partsTable.addRow(**partRow)
-
-        with open(starFile, 'w') as f:
+        # Rows are streamed to the file, so only the columns are needed
+        columns = self._createColumnsFromDict(partRow)
+        nCols = len(columns)
+        self._columnNames = [c.getName() for c in columns]
+
+        # From now on, alignment values are computed in chunks. If there is
+        # a postprocessImageRow function, it should see (and might modify)
+        # the alignment values of each row, so they are set row by row.
+        self._alignCount = 0
+        if self._setAlign and not self._postprocessImageRow:
+            keys = list(partRow.keys())
+            self._alignColumns = [keys.index(l) for l in self._alignLabels]
+            self._alignMatrices = np.empty((WRITE_CHUNK_SIZE, 4, 4))
+            self._setAlign = self._alignToBuffer
+
+        with open(starFile, 'w', buffering=STAR_BUFFER_SIZE) as f:
             # Write particles table
             f.write("# Star file generated with Scipion\n")
             f.write("\n# version 30001\n")
@@ -454,14 +677,22 @@ class Writer(WriterBase):
             # Write header first
             partsWriter = Table.Writer(f)
             partsWriter.writeTableName('particles')
-            partsWriter.writeHeader(partsTable.getColumns())
-            # Write all rows
-            for part in partsSet:
+            partsWriter.writeHeader(columns)
+            # Write all rows, in chunks
+            self._lineFormat = None
+            rowsValues = []
+            for part in itertools.chain([firstPart], iterParts):
                 self._partToRow(part, partRow)
                 if self._postprocessImageRow:
                     self._postprocessImageRow(part, partRow)
-                partsWriter.writeRowValues(partRow.values())
-                # partsTable.writeStarLine(f, partRow.values())
+                # Rows are written by position. The row dict only grows, with
+                # new keys at the end, so extra columns that were not in the
+                # first particle are ignored (as Table.Writer did before)
+                rowsValues.append(list(partRow.values())[:nCols])
+                if len(rowsValues) == WRITE_CHUNK_SIZE:
+                    self._writeRows(f, rowsValues)
+                    rowsValues = []
+            self._writeRows(f, rowsValues)
 
 
 class Reader(ReaderBase):
@@ -525,6 +756,8 @@ class Reader(ReaderBase):
         partsReader = Table.Reader(starFile, tableName='particles')
 
         firstRow = partsReader.getRow()
+        # Optional columns are checked once here, instead of for every row
+        self._setObjId = hasattr(firstRow, 'rlnImageId')
         self._setClassId = hasattr(firstRow, 'rlnClassNumber')
         self._setCtf = partsReader.hasAllColumns(self.CTF_LABELS[:3])
         self._setCoord = partsReader.hasAllColumns(self.COORD_LABELS[:3])
@@ -532,6 +765,20 @@ class Reader(ReaderBase):
 
         if self._setCtf:
             particle.setCTF(CTFModel())
+            self._ctfFlags = self.ctfFlags(firstRow)
+            # Consecutive particles usually share the same CTF values (e.g.
+            # same micrograph), so the CTF is only set when these change.
+            # The pre/post-process functions might modify the CTF, so in
+            # that case it is always set.
+            ctfLabels = [l for l in ['rlnDefocusU', 'rlnDefocusV',
+                                     'rlnDefocusAngle', 'rlnCtfMaxResolution',
+                                     'rlnCtfFigureOfMerit', 'rlnPhaseShift',
+                                     'rlnCtfImage']
+                         if hasattr(firstRow, l)]
+            self._ctfKey = operator.attrgetter(*ctfLabels)
+            self._reuseCtf = not (self._preprocessImageRow or
+                                  self._postprocessImageRow)
+            self._lastCtfKey = None
 
         self._setAcq = kwargs.get("readAcquisition", True)
         if self._setAcq:
@@ -554,20 +801,37 @@ class Reader(ReaderBase):
         extraLabels = kwargs.get('extraLabels', []) + PARTICLE_EXTRA_LABELS
         self.createExtraLabels(particle, firstRow, extraLabels)
 
-        self._rowToPart(firstRow, particle)
         partSet.setSamplingRate(self._pixelSize)
         self._optics.toImages(partSet)
-        partSet.append(particle)
 
-        for row in partsReader:
-            self._rowToPart(row, particle)
-            partSet.append(particle)
+        # Transformation matrices are computed for a chunk of rows at once
+        self._setTransform = (self._alignType != ALIGN_NONE and
+                              partsReader.hasAnyColumn(self.ALIGNMENT_LABELS))
+        if self._setTransform:
+            particle.setTransform(Transform())
+
+        types = [c.getType() for c in partsReader.getColumns()]
+        matricesBuffer = np.empty((READ_CHUNK_SIZE, 4, 4))
+
+        for rows in iterStarRows(starFile, 'particles', partsReader.Row,
+                                 types, READ_CHUNK_SIZE):
+            if self._setTransform:
+                # The matrices buffer is reused for all chunks
+                if len(rows) > len(matricesBuffer):
+                    matricesBuffer = np.empty((len(rows), 4, 4))
+                matrices = self.rowsToMatrices(rows, out=matricesBuffer)
+            else:
+                matrices = itertools.repeat(None)
+
+            for row, matrix in zip(rows, matrices):
+                self._rowToPart(row, particle, matrix)
+                partSet.append(particle)
 
         partSet.setHasCTF(self._setCtf)
         partSet.setAlignment(self._alignType)
 
-    def _rowToPart(self, row, particle):
-        particle.setObjId(getattr(row, 'rlnImageId', None))
+    def _rowToPart(self, row, particle, matrix=None):
+        particle.setObjId(row.rlnImageId if self._setObjId else None)
 
         if self._preprocessImageRow:
             self._preprocessImageRow(particle, row)
@@ -580,9 +844,16 @@ class Reader(ReaderBase):
             particle.setClassId(row.rlnClassNumber)
 
         if self._setCtf:
-            self.rowToCtf(row, particle.getCTF())
-
-        self.setParticleTransform(particle, row)
+            ctfKey = self._ctfKey(row)
+            if ctfKey != self._lastCtfKey:
+                self.rowToCtf(row, particle.getCTF(), self._ctfFlags)
+                if self._reuseCtf:
+                    self._lastCtfKey = ctfKey
+
+        if matrix is None:
+            self.setParticleTransform(particle, row)
+        else:
+            particle.getTransform().setMatrix(matrix)
         self.setExtraLabels(particle, row)
 
         # TODO: coord extra labels, partId, micId,
@@ -604,19 +875,34 @@ class Reader(ReaderBase):
         return coord
 
     @staticmethod
-    def rowToCtf(row, ctf):
-        """ Create a CTFModel from the row. """
+    def ctfFlags(row):
+        """ Return a tuple telling if the row has the optional CTF columns:
+        max resolution, figure of merit, phase shift and CTF image.
+        """
+        return tuple(hasattr(row, l) for l in ['rlnCtfMaxResolution',
+                                               'rlnCtfFigureOfMerit',
+                                               'rlnPhaseShift',
+                                               'rlnCtfImage'])
+
+    @staticmethod
+    def rowToCtf(row, ctf, flags=None):
+        """ Create a CTFModel from the row.
+        The flags (see ctfFlags) can be passed when setting many rows
+        with the same columns, otherwise they are computed from the row.
+        """
+        hasResolution, hasFitQuality, hasPhaseShift, hasImage = (
+            flags or Reader.ctfFlags(row))
         ctf.setDefocusU(row.rlnDefocusU)
         ctf.setDefocusV(row.rlnDefocusV)
         ctf.setDefocusAngle(row.rlnDefocusAngle)
-        ctf.setResolution(row.get('rlnCtfMaxResolution', 0))
-        ctf.setFitQuality(row.get('rlnCtfFigureOfMerit', 0))
+        ctf.setResolution(row.rlnCtfMaxResolution if hasResolution else 0)
+        ctf.setFitQuality(row.rlnCtfFigureOfMerit if hasFitQuality else 0)
 
-        if hasattr(row, 'rlnPhaseShift'):
+        if hasPhaseShift:
             ctf.setPhaseShift(row.rlnPhaseShift)
         ctf.standardize()
 
-        if hasattr(row, 'rlnCtfImage'):
+        if hasImage:
             ctf.setPsdFile(row.rlnCtfImage)
 
     @staticmethod
@@ -625,6 +911,51 @@ class Reader(ReaderBase):
         acq.setSphericalAberration(optics.rlnSphericalAberration)
         acq.setVoltage(optics.rlnVoltage)
 
+    def rowsToMatrices(self, rows, out=None):
+        """ Compute the transformation matrices for a list of rows
+        in a single vectorized pass.
+
+        Params:
+            rows: list of rows with the alignment columns.
+            out: optional (M, 4, 4) array, with M >= N, where the matrices
+                will be written instead of allocating a new array.
+        Return:
+            A (N, 4, 4) array with the matrix for each of the N rows.
+        """
+        firstRow = rows[0]
+        labels = [l for l in self.ALIGNMENT_LABELS if firstRow.hasColumn(l)]
+        values = np.array([[getattr(row, l) for l in labels] for row in rows],
+                          dtype=float).reshape(len(rows), len(labels))
+        columns = {l: values[:, i] for i, l in enumerate(labels)}
+        zeros = np.zeros(len(rows))
+
+        def _get(label):
+            return columns.get(label, zeros)
+
+        ips = self._invPixelSize
+        shifts = np.stack([_get('rlnOriginXAngst') * ips,
+                           _get('rlnOriginYAngst') * ips,
+                           _get('rlnOriginZAngst') * ips], axis=1)
+
+        if self._alignType == ALIGN_2D:
+            M = eulerMatrices(zeros, zeros, -np.deg2rad(_get('rlnAnglePsi')),
+                              out=out)
+            M[:, :2, 3] = shifts[:, :2]
+        elif self._alignType == ALIGN_PROJ:
+            M = eulerMatrices(np.deg2rad(_get('rlnAngleRot')),
+                              np.deg2rad(_get('rlnAngleTilt')),
+                              np.deg2rad(_get('rlnAnglePsi')), out=out)
+            # The matrix is a rigid transformation with -shifts as
+            # translation, so the inverse is computed analytically
+            Rt = M[:, :3, :3].transpose(0, 2, 1).copy()
+            M[:, :3, :3] = Rt
+            M[:, :3, 3] = np.einsum('nij,nj->ni', Rt, shifts)
+        else:
+            raise TypeError("Unexpected alignment type: %s"
+                            % self._alignType)
+
+        return M
+
     def setParticleTransform(self, particle, row):
         """ Set the transform values from the row. """
 
@@ -632,10 +963,10 @@ class Reader(ReaderBase):
                 not row.hasAnyColumn(self.ALIGNMENT_LABELS)):
             self.setParticleTransform = self.__setParticleTransformNone
         else:
-            # Ensure the Transform object exists
-            self._angles = np.zeros(3)
-            self._shifts = np.zeros(3)
-
+            # Ensure the Transform object exists. The matrix is reused to
+            # compute the values of all rows, but each particle gets a copy
+            # since Transform keeps a reference to it
+            self._matrix = np.eye(4)
             particle.setTransform(Transform())
 
             if self._alignType == ALIGN_2D:
@@ -653,42 +984,24 @@ class Reader(ReaderBase):
         particle.setTransform(None)
 
     def __setParticleTransform2D(self, particle, row):
-        angles = self._angles
-        shifts = self._shifts
         ips = self._invPixelSize
-
-        def _get(label):
-            return float(getattr(row, label, 0.))
-
-        shifts[0] = _get('rlnOriginXAngst') * ips
-        shifts[1] = _get('rlnOriginYAngst') * ips
-        angles[2] = -_get('rlnAnglePsi')
-        radAngles = -np.deg2rad(angles)
-        M = tfs.euler_matrix(radAngles[0], radAngles[1], radAngles[2], 'szyz')
-        M[:3, 3] = shifts[:3]
-        particle.getTransform().setMatrix(M)
+        M = self._matrix
+        setEulerMatrix(M, 0., 0., -getattr(row, 'rlnAnglePsi', 0.) * _DEG2RAD)
+        M[0, 3] = getattr(row, 'rlnOriginXAngst', 0.) * ips
+        M[1, 3] = getattr(row, 'rlnOriginYAngst', 0.) * ips
+        particle.getTransform().setMatrix(M.copy())
 
     def __setParticleTransformProj(self, particle, row):
-        angles = self._angles
-        shifts = self._shifts
         ips = self._invPixelSize
-
-        def _get(label):
-            return float(getattr(row, label, 0.))
-
-        shifts[0] = _get('rlnOriginXAngst') * ips
-        shifts[1] = _get('rlnOriginYAngst') * ips
-        shifts[2] = _get('rlnOriginZAngst') * ips
-
-        angles[0] = _get('rlnAngleRot')
-        angles[1] = _get('rlnAngleTilt')
-        angles[2] = _get('rlnAnglePsi')
-
-        radAngles = -np.deg2rad(angles)
-
-        # TODO: jmrt: Maybe we should test performance and consider if keeping
-        # TODO: the matrix and not creating one everytime will make things faster
-        M = tfs.euler_matrix(radAngles[0], radAngles[1], radAngles[2], 'szyz')
-        M[:3, 3] = -shifts[:3]
-        M = np.linalg.inv(M)
-        particle.getTransform().setMatrix(M)
+        M = self._matrix
+        # The final matrix is the inverse of the rigid transformation with
+        # rotation R and translation -shifts, i.e. R.T and R.T * shifts.
+        # So the rotation is directly written transposed.
+        setEulerMatrix(M.T,
+                       getattr(row, 'rlnAngleRot', 0.) * _DEG2RAD,
+                       getattr(row, 'rlnAngleTilt', 0.) * _DEG2RAD,
+                       getattr(row, 'rlnAnglePsi', 0.) * _DEG2RAD)
+        M[:3, 3] = M[:3, :3].dot((getattr(row, 'rlnOriginXAngst', 0.) * ips,
+                                  getattr(row, 'rlnOriginYAngst', 0.) * ips,
+                                  getattr(row, 'rlnOriginZAngst', 0.) * ips))
+        particle.getTransform().setMatrix(M.copy())
@@ -137,13 +137,18 @@ class WriterBase:
 
         return newPath
 
-    def _createTableFromDict(self, rowDict):
-        """ Helper function to create a Table instance from
+    def _createColumnsFromDict(self, rowDict):
+        """ Helper function to create the list of Table columns from
         an input dict with keys as columns names and type
         the type of the values in the dict.
         """
-        return Table(columns=[
-            Table.Column(k, type=type(v)) for k, v in rowDict.items()])
+        return [Table.Column(k, type=type(v)) for k, v in rowDict.items()]
+
+    def _createTableFromDict(self, rowDict):
+        """ Helper function to create a Table instance from
+        an input dict (see _createColumnsFromDict).
+        """
+        return Table(columns=self._createColumnsFromDict(rowDict))
 
     def _micToRow(self, mic, row):
         row['rlnImageId'] = mic.getObjId()
@@ -31,6 +31,11 @@ newer Relion3.1 routines and old ones.
 """
 
 import os
+import re
+import mmap
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from emtable import Table
 
 import pyworkflow.utils as pwutils
@@ -53,14 +58,155 @@ def locationToRelion(index, filename):
 def relionToLocation(filename):
     """ Return a location (index, filename) given
     a Relion filename with the index@filename structure. """
-    if '@' in filename:
-        indexStr, fn = filename.split('@')
-        return int(indexStr), str(fn)
+    indexStr, sep, fn = filename.rpartition('@')
+    if sep:
+        return int(indexStr), fn
     else:
-        return NO_INDEX, str(filename)
+        return NO_INDEX, filename
 
 
-def convertBinaryFiles(imgSet, outputDir, extension='mrcs', forceConvert=False):
+# Match the end of the rows of a table: either an empty line or a new block
+_TABLE_END = re.compile(rb'\n[ \t\r]*\n|\ndata_')
+
+
+def _findTableRows(mm, tableName):
+    """ Return the offset of the first data line of the given table
+    in a memory-mapped STAR file.
+    """
+    dataStr = b'data_' + (tableName or '').encode()
+    if mm[:len(dataStr)] == dataStr:
+        pos = 0
+    else:
+        pos = mm.find(b'\n' + dataStr)
+        if pos < 0:
+            raise Exception("'%s' block was not found" % dataStr.decode())
+        pos += 1
+
+    size = len(mm)
+    foundLabels = False
+    pos = mm.find(b'\n', pos) + 1 or size
+
+    while pos < size:
+        nextPos = mm.find(b'\n', pos)
+        if nextPos < 0:
+            nextPos = size
+        line = mm[pos:nextPos].strip()
+        if line.startswith(b'_'):
+            foundLabels = True
+        elif foundLabels:
+            break
+        pos = nextPos + 1
+
+    return pos
+
+
+def _bytesConverter(colType):
+    """ Return a function to convert a bytes token into colType. """
+    if colType is str:
+        return bytes.decode
+    if colType in (int, float):
+        return colType
+    return lambda v: colType(v.decode())
+
+
+def iterStarRows(starFile, tableName, Row, types, chunkSize=10000):
+    """ Iterate over the rows of a table in a STAR file, reading them
+    in chunks. The file is memory-mapped and each chunk of lines is split
+    at once (as bytes), then values are converted column by column.
+
+    Params:
+        starFile: the filename of the star file.
+        tableName: name of the table (loop) that will be read.
+        Row: the class of the rows, e.g. Table.Reader.Row
+        types: list with the type of each column.
+        chunkSize: approximated number of rows in each chunk.
+    Return:
+        An iterator over lists of rows.
+    """
+    nCols = len(types)
+    converters = [_bytesConverter(t) for t in types]
+
+    with open(starFile, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise Exception("'data_%s' block was not found" % tableName)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = _findTableRows(mm, tableName)
+            m = _TABLE_END.search(mm, start - 1)
+            end = m.start() if m else len(mm)
+            # Estimate the size (in bytes) of a chunk from the first line
+            lineSize = (mm.find(b'\n', start, end) + 1 or end) - start
+            chunkBytes = max(lineSize, 1) * chunkSize
+
+            while start < end:
+                stop = min(start + chunkBytes, end)
+                if stop < end:
+                    stop = mm.find(b'\n', stop, end) + 1 or end
+                data = mm[start:stop]
+                start = stop
+
+                if b'"' in data or b"'" in data:
+                    values = [shlex.split(l)
+                              for l in data.decode().splitlines()]
+                    convs = types
+                else:
+                    values = [l.split() for l in data.splitlines()]
+                    convs = converters
+
+                if sum(map(len, values)) != nCols * len(values):
+                    raise Exception("Wrong number of values in table '%s' "
+                                    "from file: %s" % (tableName, starFile))
+
+                columns = [list(map(c, v))
+                           for c, v in zip(convs, zip(*values))]
+                yield list(map(Row._make, zip(*columns)))
+
+
+def _copyFile(fn, newFn):
+    """ Copy a file without reading it from Python. copy_file_range might
+    even clone the file on filesystems with reflinks (e.g. Btrfs, XFS).
+    If not available, shutil.copyfile will use sendfile when possible.
+    """
+    copyRange = getattr(os, 'copy_file_range', None)
+    if copyRange is not None:
+        try:
+            with open(fn, 'rb') as fIn, open(newFn, 'wb') as fOut:
+                size = os.fstat(fIn.fileno()).st_size
+                while size > 0:
+                    n = copyRange(fIn.fileno(), fOut.fileno(), size)
+                    if n == 0:  # e.g. the file shrank, copy it again below
+                        break
+                    size -= n
+            if size <= 0:
+                return
+        except OSError:
+            pass  # e.g. not supported between these filesystems
+    shutil.copyfile(fn, newFn)
+
+
+def _isSameFile(fn1, fn2):
+    """ Return True if both names exist and point to the same file. """
+    try:
+        return os.path.samefile(fn1, fn2)
+    except OSError:
+        return False
+
+
+def _convertStack(fnPair):
+    """ Convert a stack file, with its own ImageHandler since
+    it can not be shared between threads. If the input is already
+    an mrcs stack, the file is just copied.
+    """
+    fn, newFn = fnPair
+    if fn.endswith('.mrcs') and newFn.endswith('.mrcs'):
+        _copyFile(fn, newFn)
+    else:
+        ImageHandler().convertStack(fn, newFn)
+    return fnPair
+
+
+def convertBinaryFiles(imgSet, outputDir, extension='mrcs', forceConvert=False,
+                       nThreads=1):
     """ Convert binary images files to a format read by Relion.
     Or create links if there is no need to convert the binary files.
 
@@ -69,70 +215,95 @@ def convertBinaryFiles(imgSet, outputDir, extension='mrcs', forceConvert=False):
         outputDir: where to put the converted file(s)
         extension: extension accepted by the program
         forceConvert: if True, the files will be converted and no root will be used
+        nThreads: number of threads used to convert the stacks
     Return:
         A dictionary with old-file as key and new-file as value
         If empty, not conversion was done.
     """
     filesDict = {}
-    ih = ImageHandler()
+    usedNames = set()  # same as filesDict values, for fast lookups
+    stacksToConvert = []
     outputRoot = outputDir if forceConvert else os.path.join(outputDir, 'input')
     # Get the extension without the dot
     stackFiles = imgSet.getFiles()
     ext = pwutils.getExt(next(iter(stackFiles)))[1:]
-    rootDir = pwutils.commonPath(list(stackFiles))
 
     def getUniqueFileName(fn, extension):
         """ Get an unique file for either link or convert files.
         It is possible that the base name overlap if they come
         from different runs. (like particles.mrcs after relion preprocess)
         """
-        newFn = os.path.join(outputRoot, pwutils.replaceBaseExt(fn, extension))
-        newRoot = pwutils.removeExt(newFn)
-
-        values = filesDict.values()
+        baseName = os.path.basename(fn).rsplit('.', 1)[0]  # no extension
+        newRoot = os.path.join(outputRoot, baseName)
+        newFn = '%s.%s' % (newRoot, extension)
         counter = 1
 
-        while newFn in values:
+        while newFn in usedNames:
             counter += 1
             newFn = '%s_%05d.%s' % (newRoot, counter, extension)
 
+        usedNames.add(newFn)
         return newFn
 
+    useHardLinks = True
+
+    def createFileLink(fn, newFn):
+        """ Try first a hard link, that does not need to be resolved
+        when the file is opened. If not possible (e.g. different devices
+        or not supported by the filesystem) use symbolic links from now on.
+        """
+        nonlocal useHardLinks
+        if useHardLinks:
+            try:
+                os.link(fn, newFn)
+                return
+            except OSError:
+                useHardLinks = False
+        pwutils.createLink(fn, newFn)
+
     def createBinaryLink(fn):
         """ Just create a link named .mrcs to Relion understand
         that it is a binary stack file and not a volume.
         """
         newFn = getUniqueFileName(fn, extension)
-        if not os.path.exists(newFn):
-            pwutils.createLink(fn, newFn)
-            print("   %s -> %s" % (newFn, fn))
+        baseName = os.path.basename(newFn)
+        if baseName in existingNames:
+            if _isSameFile(fn, newFn):
+                return newFn
+            # A hard link from a previous run keeps the old content if
+            # the input file was regenerated, so link it again. The output
+            # root is never a link to the input folder (see below), so
+            # only the links created here are removed
+            os.remove(newFn)
+        createFileLink(fn, newFn)
+        existingNames.add(baseName)
+        print("   %s -> %s" % (newFn, fn))
         return newFn
 
     def convertStack(fn):
         """ Convert from a format that is not read by Relion
-        to an spider stack.
+        to an spider stack. Only the new name is computed here,
+        the conversion is done later for all files.
         """
         newFn = getUniqueFileName(fn, 'mrcs')
-        ih.convertStack(fn, newFn)
-        print("   %s -> %s" % (newFn, fn))
+        stacksToConvert.append((fn, newFn))
         return newFn
 
-    def replaceRoot(fn):
-        """ Link create to the root folder, so just replace that
-        in the name, no need to do anything else.
-        """
-        return fn.replace(rootDir, outputRoot)
-
     if forceConvert:
         print("convertBinaryFiles: forceConvert = True")
         mapFunc = convertStack
     elif ext == extension:
+        rootDir = pwutils.commonPath(list(stackFiles))
         print("convertBinaryFiles: creating soft links.")
         print("   Root: %s -> %s" % (outputRoot, rootDir))
-        mapFunc = replaceRoot
         pwutils.createAbsLink(os.path.abspath(rootDir), outputRoot)
+        # Link created to the root folder, so just replace that in the
+        # names, no need to do anything else. The root folder is the
+        # common path of all files, so it is always a prefix.
+        rootLen = len(rootDir)
+        return {fn: outputRoot + fn[rootLen:] for fn in stackFiles}
     elif ext == 'mrc' and extension == 'mrcs':
-        print("convertBinaryFiles: creating soft links (mrcs -> mrc).")
+        print("convertBinaryFiles: creating hard or soft links (mrcs -> mrc).")
         mapFunc = createBinaryLink
     elif ext.endswith('hdf'):  # assume eman .hdf format
         print("convertBinaryFiles: converting stacks. (%s -> %s)"
@@ -142,11 +313,25 @@ def convertBinaryFiles(imgSet, outputDir, extension='mrcs', forceConvert=False):
         mapFunc = None
 
     if mapFunc is not None:
+        # A previous run might have linked the output root to the input
+        # folder (see above). Remove that link (not the input files) to
+        # not create or remove any file among the input files
+        if outputRoot != outputDir and os.path.islink(outputRoot):
+            os.remove(outputRoot)
         pwutils.makePath(outputRoot)
+        # List the output folder once, instead of checking each file
+        existingNames = {e.name for e in os.scandir(outputRoot)}
         for fn in stackFiles:
             newFn = mapFunc(fn)  # convert or link
             filesDict[fn] = newFn  # map new filename
 
+        # Names are already unique, so the files can be converted in parallel
+        if stacksToConvert:
+            nThreads = max(1, min(nThreads, len(stacksToConvert)))
+            with ThreadPoolExecutor(max_workers=nThreads) as executor:
+                for fn, newFn in executor.map(_convertStack, stacksToConvert):
+                    print("   %s -> %s" % (newFn, fn))
+
     return filesDict
 
 
@@ -158,20 +343,67 @@ def convertBinaryVol(vol, outputDir):
     Return:
         new file name of the volume (converted or not).
     """
-
-    ih = ImageHandler()
     fn = vol.getFileName()
 
     if not fn.endswith('.mrc'):
         newFn = os.path.join(outputDir, pwutils.replaceBaseExt(fn, 'mrc'))
-        ih.convert(fn, newFn)
+        ImageHandler().convert(fn, newFn)
         return newFn
 
     return fn
 
 
+def _convertVol(fnPair):
+    """ Convert a volume file, with its own ImageHandler since
+    it can not be shared between threads.
+    """
+    ImageHandler().convert(*fnPair)
+
+
+def convertBinaryVols(vols, outputDir, nThreads=1):
+    """ Convert several volumes (see convertBinaryVol), optionally
+    using threads. Output names are made unique first, since volumes
+    from different runs might have the same base name.
+    Params:
+        vols: list of input volume objects to be converted.
+        outputDir: where to put the converted file(s)
+        nThreads: maximum number of volumes converted at the same time
+    Return:
+        list with the new file names of the volumes, in the same order.
+    """
+    newFns = []
+    usedNames = set()
+    volsToConvert = []
+
+    for vol in vols:
+        fn = vol.getFileName()
+        if fn.endswith('.mrc'):
+            newFns.append(fn)
+            continue
+        newRoot = os.path.join(outputDir, pwutils.removeBaseExt(fn))
+        newFn = newRoot + '.mrc'
+        counter = 1
+        while newFn in usedNames:
+            counter += 1
+            newFn = '%s_%05d.mrc' % (newRoot, counter)
+        usedNames.add(newFn)
+        newFns.append(newFn)
+        volsToConvert.append((fn, newFn))
+
+    # Output names are unique, so no file is written by two threads
+    nThreads = min(nThreads, len(volsToConvert))
+    if nThreads > 1:
+        with ThreadPoolExecutor(max_workers=nThreads) as executor:
+            list(executor.map(_convertVol, volsToConvert))
+    else:
+        for fnPair in volsToConvert:
+            _convertVol(fnPair)
+
+    return newFns
+
+
 def convertMask(img, outputPath, newPix=None,
-                newDim=None, threshold=True, invert=False):
+                newDim=None, threshold=True, invert=False, fastCopy=False):
     """ Convert mask to mrc format read by Relion.
     Params:
         img: input image to be converted.
@@ -181,6 +413,10 @@ def convertMask(img, outputPath, newPix=None,
             it is assumed is the output filename.
         newPix: output pixel size (equals input if None)
         newDim: output box size
+        fastCopy: if True and the mask is not thresholded, rescaled,
+            resized or inverted, it is just converted to mrc (with the
+            input pixel size in the header), avoiding to launch
+            relion_image_handler.
     Return:
         new file name of the mask.
     """
@@ -193,6 +429,19 @@ def convertMask(img, outputPath, newPix=None,
     else:
         outFn = outputPath
 
+    if (fastCopy and not threshold and not invert
+            and newPix is None and newDim is None):
+        try:
+            # Not available before scipion-em 3.0.16
+            from pwem.convert.headers import setMRCSamplingRate
+        except ImportError:
+            pass  # use relion_image_handler below
+        else:
+            ImageHandler().convert(img, outFn)
+            # Same header pixel size that relion_image_handler --angpix sets
+            setMRCSamplingRate(outFn, inPix)
+            return outFn
+
     if invert:
         # unfortunately relion does not allow to use
         # add_constant and multiply_constant together
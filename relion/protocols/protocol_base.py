@@ -780,15 +780,19 @@ class ProtRelionBase(EMProtocol):
             hasAlign = alignType != ALIGN_NONE
             alignToPrior = hasAlign and getattr(self, 'alignmentAsPriors', False)
 
+            # Only pass the row function when it does something, since
+            # alignment values are computed faster in chunks without it
+            postprocessImageRow = None
             if self.doCtfManualGroups:
                 self._defocusGroups = self.createDefocusGroups()
                 print(self._defocusGroups)
+                postprocessImageRow = self._postprocessParticleRow
 
             relion.convert.writeSetOfParticles(
                 imgSet, imgStar,
                 outputDir=self._getExtraPath(),
                 alignType=alignType,
-                postprocessImageRow=self._postprocessParticleRow)
+                postprocessImageRow=postprocessImageRow)
 
             if alignToPrior:
                 mdOptics = Table(fileName=imgStar, tableName='optics')
@@ -1232,7 +1236,8 @@ class ProtRelionBase(EMProtocol):
                 relion.convert.convertMask(inputVol, outputFn, newPix=newPix,
                                            newDim=newDim, threshold=False)
             else:
-                relion.convert.convertMask(inputVol, outputFn, threshold=False)
+                relion.convert.convertMask(inputVol, outputFn, threshold=False,
+                                           fastCopy=True)
 
         return outputFn
 
@@ -119,12 +119,13 @@ class ProtRelionCreateMask3D(ProtCreateMask3D):
     
     # --------------------------- STEPS functions -----------------------------
     def convertInputStep(self, volId):
-        self.inputVolFn = convert.convertBinaryVol(
-            self.inputVolume.get(), self._getTmpPath())
-
         if self.doCompare:
-            self.inputVol2Fn = convert.convertBinaryVol(
-                self.inputVolume2.get(), self._getTmpPath())
+            self.inputVolFn, self.inputVol2Fn = convert.convertBinaryVols(
+                [self.inputVolume.get(), self.inputVolume2.get()],
+                self._getTmpPath(), nThreads=self.numberOfThreads.get())
+        else:
+            self.inputVolFn = convert.convertBinaryVol(
+                self.inputVolume.get(), self._getTmpPath())
 
     def createMaskStep(self):
         argsDict = {'--i ': self.inputVolFn,
@@ -72,6 +72,8 @@ class ProtRelionExportParticles(ProtProcessParticles, ProtRelionBase):
                            "select to write images into a single stack file or"
                            " several stacks (one per micrograph). ")
 
+        form.addParallelSection(threads=1, mpi=0)
+
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
         objId = self.inputParticles.get().getObjId()
@@ -110,7 +112,8 @@ class ProtRelionExportParticles(ProtProcessParticles, ProtRelionBase):
             alignType=alignType,
             postprocessImageRow=postprocessImageRow,
             fillMagnification=True,
-            forceConvert=True)
+            forceConvert=True,
+            nThreads=self.numberOfThreads.get())
 
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
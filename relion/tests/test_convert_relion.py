@@ -29,20 +29,24 @@
 
 import os
 import subprocess
+from unittest import mock
 import numpy as np
 
 from pyworkflow.tests import BaseTest, setupTestOutput, DataSet
-from pyworkflow.utils import cleanPath, magentaStr, createLink, replaceExt
+from pyworkflow.utils import (cleanPath, magentaStr, createLink, replaceExt,
+                              makePath)
 from pwem.objects import (SetOfParticles, CTFModel, Acquisition,
                           SetOfMicrographs, Coordinate, Particle,
-                          SetOfVolumes, Transform)
+                          SetOfVolumes, Transform, Volume)
 from pwem.emlib.image import ImageHandler
 import pwem.emlib.metadata as md
 from pwem.constants import ALIGN_PROJ, ALIGN_2D, ALIGN_3D
+import pwem.convert.transformations as tfs
 
 from relion import Plugin
 import relion.convert as convert
-from relion.convert.convert31 import OpticsGroups
+from relion.convert.convert31 import OpticsGroups, Reader
+from relion.convert.convert_utils import iterStarRows, _copyFile
 from emtable import Table
 
 
@@ -92,6 +96,111 @@ class TestConvertBinaryFiles(BaseTest):
         print(filesDict)
 
 
+    def _linkStacks(self, stackFiles, outputDir):
+        """ Create a set with one particle per stack file and link
+        them into outputDir. Return the new file names. """
+        partSet = SetOfParticles(filename=':memory:')
+        for fn in stackFiles:
+            particle = Particle()
+            particle.setLocation(1, fn)
+            partSet.append(particle)
+        filesDict = convert.convertBinaryFiles(partSet, outputDir)
+        partSet.close()
+        return [filesDict[fn] for fn in stackFiles]
+
+    def _writeFile(self, fn, data):
+        """ Write a new file, replacing (not overwriting) any existing one. """
+        with open(fn + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(fn + '.tmp', fn)
+
+    def _readFile(self, fn):
+        with open(fn, 'rb') as f:
+            return f.read()
+
+    def test_mrcsRelink(self):
+        """ Links should be created again if the input files were
+        regenerated, and be symbolic links if hard links fail. """
+        inputDir = self.getOutputPath('relink_input')
+        makePath(inputDir)
+        stackFn = os.path.join(inputDir, 'particles.mrc')
+        outputDir = self.getOutputPath('relink_output')
+        cleanPath(outputDir)
+
+        self._writeFile(stackFn, b'first')
+        newFn, = self._linkStacks([stackFn], outputDir)
+        self.assertEqual(self._readFile(newFn), b'first')
+
+        self._writeFile(stackFn, b'second')
+        newFn, = self._linkStacks([stackFn], outputDir)
+        self.assertEqual(self._readFile(newFn), b'second')
+
+        outputDir = self.getOutputPath('relink_output_symlinks')
+        cleanPath(outputDir)
+        with mock.patch.object(os, 'link', side_effect=OSError):
+            newFn, = self._linkStacks([stackFn], outputDir)
+        self.assertTrue(os.path.islink(newFn))
+        self.assertEqual(self._readFile(newFn), b'second')
+
+    def test_mrcsLinkAfterRootLink(self):
+        """ Input files should not be touched if a previous run
+        linked the output folder to the input folder. """
+        inputDir = self.getOutputPath('rootlink_input')
+        otherDir = self.getOutputPath('rootlink_other')
+        makePath(inputDir, otherDir)
+        mrcsFn = os.path.join(inputDir, 'particles.mrcs')
+        mrcFn = os.path.join(otherDir, 'particles.mrc')
+        self._writeFile(mrcsFn, b'input')
+        self._writeFile(mrcFn, b'other')
+        outputDir = self.getOutputPath('rootlink_output')
+        cleanPath(outputDir)
+        makePath(outputDir)
+
+        self._linkStacks([mrcsFn], outputDir)  # links the whole folder
+        newFn, = self._linkStacks([mrcFn], outputDir)
+        self.assertEqual(self._readFile(mrcsFn), b'input')
+        self.assertEqual(self._readFile(newFn), b'other')
+
+    def test_copyFile(self):
+        """ The copy should have the same bytes than the source, also
+        if copy_file_range stops before the end of the file. """
+        fn = self.getOutputPath('copy_source.mrcs')
+        data = os.urandom(3 * 1024 * 1024 + 7)
+        with open(fn, 'wb') as f:
+            f.write(data)
+
+        def _check(newFn):
+            _copyFile(fn, newFn)
+            with open(newFn, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+        _check(self.getOutputPath('copy_target.mrcs'))
+
+        with mock.patch.object(os, 'copy_file_range', create=True,
+                               return_value=0):
+            _check(self.getOutputPath('copy_target_fallback.mrcs'))
+
+
+    def test_convertBinaryVols(self):
+        """ Volumes with the same base name should not be converted
+        to the same output file. """
+        vols = []
+        for i in range(1, 4):
+            volDir = self.getOutputPath('vols%d' % i)
+            makePath(volDir)
+            volFn = os.path.join(volDir, 'volume.vol')
+            ImageHandler().createEmptyImage(volFn, 8, 8, 8)
+            vols.append(Volume(location=volFn))
+
+        outputDir = self.getOutputPath('vols_converted')
+        makePath(outputDir)
+        newFns = convert.convertBinaryVols(vols, outputDir, nThreads=2)
+        self.assertEqual(len(set(newFns)), len(vols))
+        for fn in newFns:
+            self.assertTrue(fn.endswith('.mrc'))
+            self.assertTrue(os.path.exists(fn), "Missing volume: %s" % fn)
+
+
 SHOW_IMAGES = False  # Launch xmipp_showj to open intermediate results
 CLEAN_IMAGES = True  # Remove the output temporary files
 PRINT_MATRIX = True
@@ -105,6 +214,36 @@ def runRelionProgram(cmd):
     return p.wait()
 
 
+def alignmentMatrix(row, alignType, pixelSize):
+    """ Compute the transformation matrix of a particle row from its
+    angles and shifts in the usual (non vectorized) way. """
+    shifts = np.array([row.rlnOriginXAngst, row.rlnOriginYAngst, 0])
+    shifts /= pixelSize
+
+    if alignType == ALIGN_2D:
+        M = tfs.euler_matrix(0, 0, np.deg2rad(row.rlnAnglePsi), 'szyz')
+        M[:3, 3] = shifts
+    else:
+        angles = [row.rlnAngleRot, row.rlnAngleTilt, row.rlnAnglePsi]
+        M = tfs.euler_matrix(*(-np.deg2rad(angles)), 'szyz')
+        M[:3, 3] = -shifts
+        M = np.linalg.inv(M)
+
+    return M
+
+
+def randomAlignmentRows(n, seed=0):
+    """ Create a Table with n rows of random angles and shifts.
+    A fixed seed is used, so the same rows are created each time. """
+    rng = np.random.default_rng(seed)
+    table = Table(columns=['rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi',
+                           'rlnOriginXAngst', 'rlnOriginYAngst'])
+    for _ in range(n):
+        table.addRow(*rng.uniform(-180, 180, 3),
+                     *rng.uniform(-10, 10, 2))
+    return list(table)
+
+
 class TestConvertAnglesBase(BaseTest):
     """ Base class to launch both Alignment and Reconstruction tests."""
     IS_ALIGNMENT = None
@@ -740,6 +879,81 @@ class TestRelionWriter(BaseTest):
         starWriter = convert.createWriter()
         starWriter.writeSetOfParticles(outputParts, outputStar)
 
+    def test_alignmentToRow(self):
+        """ Alignment values computed row by row should be the same
+        as the ones computed for a chunk of particles at once. """
+        rows = randomAlignmentRows(25)
+        # Also check the case of tilt = 0
+        rows.append(rows[0]._replace(rlnAngleTilt=0.))
+
+        for alignType in [ALIGN_2D, ALIGN_PROJ]:
+            writer = convert.createWriter()
+            writer._pixelSize = 1.5
+            writer._alignProj = alignType == ALIGN_PROJ
+            alignToRow = (writer._alignProjToRow if writer._alignProj
+                          else writer._align2DToRow)
+            matrices = [alignmentMatrix(row, alignType, 1.5) for row in rows]
+            values = writer._alignmentValues(np.array(matrices))
+
+            for matrix, rowValues in zip(matrices, values):
+                row = {}
+                alignToRow(Transform(matrix), row)
+                self.assertTrue(np.allclose(list(row.values()), rowValues))
+
+    def test_writeAlignment(self):
+        """ Angles and shifts written for a set of particles should give
+        back the original transformation matrices. """
+        rows = randomAlignmentRows(25)
+        stackFn = self.getOutputPath('particles.mrcs')
+
+        for alignType in [ALIGN_2D, ALIGN_PROJ]:
+            partsSqlite = self.getOutputPath('particles_align.sqlite')
+            cleanPath(partsSqlite)
+            partsSet = SetOfParticles(filename=partsSqlite)
+            partsSet.setAlignment(alignType)
+            partsSet.setSamplingRate(1.5)
+            partsSet.setAcquisition(Acquisition(voltage=300,
+                                                sphericalAberration=2,
+                                                amplitudeContrast=0.1,
+                                                magnification=60000))
+            OpticsGroups.create(rlnImageSize=64).toImages(partsSet)
+
+            matrices = [alignmentMatrix(row, alignType, 1.5) for row in rows]
+            for i, matrix in enumerate(matrices):
+                part = Particle()
+                part.setLocation(i + 1, stackFn)
+                part.setSamplingRate(1.5)
+                part.setTransform(Transform(matrix))
+                partsSet.append(part)
+            partsSet.write()
+
+            # Rows are written in chunks unless there is a
+            # postprocessImageRow function, check both ways
+            for hook in [None, lambda img, row: None]:
+                outputStar = self.getOutputPath('particles_align.star')
+                starWriter = convert.createWriter()
+                starWriter.writeSetOfParticles(partsSet, outputStar,
+                                               alignType=alignType,
+                                               postprocessImageRow=hook)
+                outRows = list(Table.iterRows('particles@' + outputStar))
+                self.assertEqual(len(outRows), len(matrices))
+                for row, matrix in zip(outRows, matrices):
+                    self.assertTrue(np.allclose(
+                        alignmentMatrix(row, alignType, 1.5), matrix))
+
+    def test_particlesNoneToStar(self):
+        """ None values can not be written to the star file. """
+        outputStar = self.getOutputPath("particles_none.star")
+        outputParts = self._createSetOfParts(2, 1, 5)
+
+        def _setGroupName(part, row):
+            row['rlnGroupName'] = None if part.getObjId() == 3 else 'group1'
+
+        starWriter = convert.createWriter()
+        with self.assertRaises(TypeError):
+            starWriter.writeSetOfParticles(outputParts, outputStar,
+                                           postprocessImageRow=_setGroupName)
+
     def test_particlesImportToStar(self):
         sqliteFn = self.ds.getFile("import/case2/particles.sqlite")
         partsSet = SetOfParticles(filename=sqliteFn)
@@ -834,6 +1048,66 @@ class TestRelionReader(BaseTest):
         self.assertEqual(x, 299)
         self.assertEqual(coord.getMicName(), 'Falcon_2012_06_12-14_33_35_0_movie.mrcs')
 
+    def test_rowsToMatrices(self):
+        """ Matrices computed for a group of rows, or row by row, should
+        match the ones computed from the Euler angles formulas. """
+        rows = randomAlignmentRows(20)
+
+        for alignType in [ALIGN_2D, ALIGN_PROJ]:
+            reader = Reader(alignType=alignType, pixelSize=1.5)
+            expected = [alignmentMatrix(row, alignType, 1.5) for row in rows]
+            matrices = reader.rowsToMatrices(rows)
+            self.assertTrue(np.allclose(matrices, expected))
+            # Results should not depend on the previous buffer content
+            self.assertTrue(np.allclose(
+                reader.rowsToMatrices(rows, out=np.ones((30, 4, 4))),
+                expected))
+            particle = Particle()
+            for row, matrix in zip(rows, expected):
+                reader.setParticleTransform(particle, row)
+                self.assertTrue(np.allclose(
+                    particle.getTransform().getMatrix(), matrix))
+
+    def test_iterStarRows(self):
+        """ Rows read in chunks should be the same as the ones
+        read by Table.iterRows. """
+        optics = ("data_optics\n\nloop_\n_rlnOpticsGroup #1\n"
+                  "_rlnImagePixelSize #2\n1 1.5\n\n")
+        particles = ("data_particles\n\nloop_\n_rlnImageName #1\n"
+                     "_rlnDefocusU #2\n_rlnClassNumber #3\n"
+                     "1@particles.mrcs 10000.5 1\n"
+                     "2@particles.mrcs 12000.0 2\n"
+                     "3@particles.mrcs 14000.25 3\n")
+        other = "data_other\n\nloop_\n_rlnClassNumber #1\n1\n"
+        quoted = particles.replace('@particles.mrcs', '@"my particles.mrcs"')
+
+        cases = {
+            'first': particles,
+            'quoted': optics + quoted,
+            'crlf': (optics + particles).replace('\n', '\r\n'),
+            'blank': optics + particles + '\n' + other,
+            'noblank': optics + particles + other,
+        }
+
+        for name, text in cases.items():
+            starFile = self.getOutputPath('rows_%s.star' % name)
+            with open(starFile, 'w', newline='') as f:
+                f.write(text)
+
+            reader = Table.Reader(starFile, tableName='particles')
+            types = [c.getType() for c in reader.getColumns()]
+            expected = list(Table.iterRows('particles@' + starFile))
+            self.assertEqual(len(expected), 3)
+
+            for chunkSize in [10000, 1]:
+                rows = [row for chunk in iterStarRows(starFile, 'particles',
+                                                      reader.Row, types,
+                                                      chunkSize=chunkSize)
+                        for row in chunk]
+                self.assertEqual(rows, expected,
+                                 "Wrong rows for case '%s' (chunkSize=%d)"
+                                 % (name, chunkSize))
+
 
 class TestRelionOpticsGroups(BaseTest):
     @classmethod